@@ -6,22 +6,76 @@ Fetches prayer times from AthanPlus for the next 6 months and produces
 a subscribable .ics file with Pre-Fajr + 5 daily prayers + worship time events.
 """
 
+import functools
+import io
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from html import unescape
+from zoneinfo import ZoneInfo
 
-import pytz
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 
 MASJID_ID = "RKxwV5dO"
 BASE_URL = "https://timing.athanplus.com/masjid/widgets/monthly"
 TIMEZONE = "America/Detroit"
-TZ = pytz.timezone(TIMEZONE)
+TZ = ZoneInfo(TIMEZONE)
+UTC = ZoneInfo("UTC")
 OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "docs")
 OUTPUT_FILE = os.path.join(OUTPUT_DIR, "naqshbandi_wird.ics")
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+CACHE_MAX_AGE_DAYS = 7
 DAYS_AHEAD = 180
+DTSTART_PREFIX = f"DTSTART;TZID={TIMEZONE}:"
+DTEND_PREFIX = f"DTEND;TZID={TIMEZONE}:"
+FETCH_WORKERS = 8
+
+# Shared across fetch threads for HTTP keep-alive / connection pooling
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "Mozilla/5.0 (compatible; NaqshbandiWirdCalendar/1.0)"
+SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS),
+)
+
+# Patterns for scanning the monthly widget table. HTML lets </tr> and </td>
+# be omitted, so rows and cells also end where the next one starts.
+ROW_RE = re.compile(
+    r"<tr\b[^>]*>(.*?)(?=</tr>|<tr\b|</t(?:body|head|foot|able)>|\Z)",
+    re.DOTALL | re.IGNORECASE,
+)
+CELL_RE = re.compile(
+    r'<td\b[^>]*\bclass="[^"]*\bregCell\b[^"]*"[^>]*>(.*?)(?=</td>|<t[dh]\b|\Z)',
+    re.DOTALL | re.IGNORECASE,
+)
+SPAN_RE = re.compile(r"<span\b[^>]*>(.*?)</span>", re.DOTALL | re.IGNORECASE)
+TAG_RE = re.compile(r"<[^>]+>")
+TIME_RE = re.compile(r"(\d{1,2}):(\d{2})")
+
+# Prayer time columns of the monthly widget, in table order
+PRAYER_KEYS = ("fajr", "sunrise", "dhuhr", "asr", "maghrib", "isha")
+
+# Hours to add to the widget's 12-hour times (Asr, Maghrib, Isha are always PM)
+PM_OFFSET = {
+    "fajr": 0, "sunrise": 0, "dhuhr": 0,
+    "asr": 12, "maghrib": 12, "isha": 12,
+}
+
+# Per-event VEVENT lines that vary by day. They are all short ASCII, so
+# they never need folding; the SUMMARY/VALARM lines come from vevent_tail().
+VEVENT_TPL = (
+    "BEGIN:VEVENT\r\n"
+    "UID:%(date)s-%(key)s@mcws-naqshbandi\r\n"
+    "%(stamp)s\r\n"
+    + DTSTART_PREFIX + "%(start)s\r\n"
+    + DTEND_PREFIX + "%(end)s\r\n"
+    "%(tail)s"
+)
 
 # Event definitions: (key, summary, offset_minutes_before_prayer, duration_minutes, alarm_minutes, prayer_key)
 # "worship" event is handled separately since its end time depends on sunrise
@@ -36,36 +90,122 @@ EVENTS = [
 ]
 
 
+def cache_path(year, month):
+    """Path of the on-disk cache entry for a given month."""
+    return os.path.join(CACHE_DIR, f"{year}-{month:02d}.json")
+
+
+def load_cached_month(year, month):
+    """Load a cached month as (days, etag, last_modified, checked), or None.
+
+    checked is the date the entry was last fetched or revalidated, if known.
+    """
+    try:
+        with open(cache_path(year, month), "rb") as f:
+            data = orjson.loads(f.read())
+        days = {}
+        for day_num, times in data["days"].items():
+            parsed = {}
+            for key in PRAYER_KEYS:
+                hour, minute = times[key]
+                parsed[key] = (int(hour), int(minute))
+            days[int(day_num)] = parsed
+        checked = data.get("checked")
+        if checked is not None:
+            checked = datetime.fromisoformat(checked).date()
+        return days, data.get("etag"), data.get("last_modified"), checked
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        # Missing or malformed entries are treated as a cache miss
+        return None
+
+
+def save_cached_month(year, month, days, checked, etag=None, last_modified=None):
+    """Atomically write parsed prayer times for a month to the cache."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    data = {
+        "checked": checked.isoformat(),
+        "etag": etag,
+        "last_modified": last_modified,
+        # Tuples are stored as [h, m] lists
+        "days": {
+            str(day_num): {key: list(hm) for key, hm in times.items()}
+            for day_num, times in days.items()
+        },
+    }
+    path = cache_path(year, month)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data))
+    os.replace(tmp_path, path)
+
+
 def fetch_month(year, month):
-    """Fetch and parse prayer times for a given month from AthanPlus."""
+    """Fetch prayer times for a month, using the on-disk cache when possible.
+
+    The current month is revalidated on every run. Later months are served
+    from the cache until their entry is CACHE_MAX_AGE_DAYS old. Stale entries
+    are revalidated with a conditional GET, and any cached entry is used if
+    the fetch fails.
+    """
+    label = f"  Fetching {year}-{month:02d} ..."
+
+    cached = load_cached_month(year, month)
+    today = datetime.now(TZ).date()
+    if cached and (year, month) != (today.year, today.month):
+        checked = cached[3]
+        if checked and 0 <= (today - checked).days < CACHE_MAX_AGE_DAYS:
+            print(f"{label} cached ({len(cached[0])} days)")
+            return cached[0]
+
     date_str = f"{year}-{month:02d}-01"
     url = f"{BASE_URL}?masjid_id={MASJID_ID}&theme=1&date={date_str}"
-    print(f"  Fetching {year}-{month:02d} ...", end=" ")
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (compatible; NaqshbandiWirdCalendar/1.0)"
-    }
+    headers = {}
+    if cached:
+        _, etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
     try:
-        resp = requests.get(url, headers=headers, timeout=30)
+        resp = SESSION.get(url, headers=headers, timeout=30)
         resp.raise_for_status()
     except requests.RequestException as e:
-        print(f"FAILED: {e}")
+        if cached:
+            print(f"{label} FAILED: {e} -- using cached ({len(cached[0])} days)")
+            return cached[0]
+        print(f"{label} FAILED: {e}")
         return {}
 
-    soup = BeautifulSoup(resp.text, "html.parser")
-    rows = soup.find_all("tr")
+    if resp.status_code == 304 and cached:
+        days, etag, last_modified, _ = cached
+        save_cached_month(year, month, days, today, etag, last_modified)
+        print(f"{label} not modified ({len(cached[0])} days)")
+        return cached[0]
+
+    days = parse_month(resp.text)
+    if days:
+        save_cached_month(
+            year, month, days, today,
+            resp.headers.get("ETag"), resp.headers.get("Last-Modified"),
+        )
+
+    print(f"{label} OK ({len(days)} days)")
+    return days
+
+
+def parse_month(html):
+    """Parse the AthanPlus monthly widget HTML into {day: {prayer: (h, m)}}."""
+    # The widget table is regular enough to scan with regexes; fall back to
+    # a full DOM parse if the markup ever changes shape.
+    rows = extract_rows_regex(html) or extract_rows_dom(html)
 
     days = {}
-    for row in rows:
-        cells = row.find_all("td", class_="regCell")
-        if len(cells) < 9:
+    for spans in rows:
+        if len(spans) < 9:
             continue
 
-        spans = []
-        for cell in cells:
-            span = cell.find("span")
-            spans.append(span.get_text(strip=True) if span else cell.get_text(strip=True))
-
         # Columns: Day#, Hijri, Weekday, Fajr, Sunrise, Dhuhr, Asr, Maghrib, Isha
         try:
             day_num = int(spans[0])
@@ -73,21 +213,48 @@ def fetch_month(year, month):
             continue
 
         times = {}
-        time_keys = ["fajr", "sunrise", "dhuhr", "asr", "maghrib", "isha"]
-        for i, key in enumerate(time_keys):
+        for i, key in enumerate(PRAYER_KEYS):
             raw = spans[3 + i].strip()
             times[key] = parse_prayer_time(raw, key)
 
         if all(v is not None for v in times.values()):
             days[day_num] = times
 
-    print(f"OK ({len(days)} days)")
     return days
 
 
+def extract_rows_regex(html):
+    """Extract the regCell texts of each table row using compiled regexes."""
+    rows = []
+    for row_html in ROW_RE.findall(html):
+        spans = []
+        for cell_html in CELL_RE.findall(row_html):
+            span = SPAN_RE.search(cell_html)
+            text = span.group(1) if span else cell_html
+            spans.append(unescape(TAG_RE.sub("", text)).strip())
+        if spans:
+            rows.append(spans)
+    return rows
+
+
+def extract_rows_dom(html):
+    """Extract the regCell texts of each table row with selectolax."""
+    tree = LexborHTMLParser(html)
+
+    rows = []
+    for row in tree.css("tr"):
+        spans = []
+        for cell in row.css("td.regCell"):
+            span = cell.css_first("span")
+            spans.append((span or cell).text(strip=True))
+        if spans:
+            rows.append(spans)
+    return rows
+
+
 def parse_prayer_time(raw, prayer_key):
     """Parse a time string like '6:15' into (hour24, minute)."""
-    match = re.match(r"(\d{1,2}):(\d{2})", raw)
+    match = TIME_RE.match(raw)
     if not match:
         return None
     hour = int(match.group(1))
@@ -96,8 +263,7 @@ def parse_prayer_time(raw, prayer_key):
     # Fajr and Sunrise are AM -- no adjustment needed.
     # Dhuhr at 12:xx stays as-is.
     # Asr, Maghrib, Isha with hour < 12 need +12 for PM.
-    if prayer_key in ("asr", "maghrib", "isha") and hour < 12:
-        hour += 12
+    hour += PM_OFFSET[prayer_key] * (hour < 12)
 
     return (hour, minute)
 
@@ -107,20 +273,17 @@ def collect_prayer_times():
     today = datetime.now(TZ).date()
     end_date = today + timedelta(days=DAYS_AHEAD)
 
-    # Determine which months to fetch
-    months_to_fetch = set()
-    d = today.replace(day=1)
-    while d <= end_date:
-        months_to_fetch.add((d.year, d.month))
-        if d.month == 12:
-            d = d.replace(year=d.year + 1, month=1)
-        else:
-            d = d.replace(month=d.month + 1)
-
-    # Fetch all months
+    # Determine which months to fetch, as zero-based month indices
+    first = today.year * 12 + today.month - 1
+    last = end_date.year * 12 + end_date.month - 1
+    months = [(m // 12, m % 12 + 1) for m in range(first, last + 1)]
+
+    # Fetch all months concurrently -- the work is network-bound
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        results = list(ex.map(lambda ym: fetch_month(*ym), months))
+
     all_days = {}
-    for year, month in sorted(months_to_fetch):
-        month_days = fetch_month(year, month)
+    for (year, month), month_days in zip(months, results):
         for day_num, times in month_days.items():
             try:
                 dt = datetime(year, month, day_num).date()
@@ -132,30 +295,50 @@ def collect_prayer_times():
     return all_days
 
 
-def fmt_dt(dt):
-    """Format a datetime as ICS local time string: YYYYMMDDTHHMMSS"""
-    return dt.strftime("%Y%m%dT%H%M%S")
+def fmt_local(date, total_minutes):
+    """Format minutes since midnight of date as ICS local time: YYYYMMDDTHHMMSS
+
+    total_minutes may fall outside 0..1439; the date rolls over accordingly.
+    """
+    day_offset, minutes = divmod(total_minutes, 1440)
+    if day_offset:
+        date += timedelta(days=day_offset)
+    return (
+        f"{date.year:04d}{date.month:02d}{date.day:02d}"
+        f"T{minutes // 60:02d}{minutes % 60:02d}00"
+    )
 
 
 def fmt_utc(dt):
     """Format a datetime as ICS UTC time string."""
-    utc_dt = dt.astimezone(pytz.utc)
+    utc_dt = dt.astimezone(UTC)
     return utc_dt.strftime("%Y%m%dT%H%M%SZ")
 
 
 def fold_line(line):
     """Fold a content line per RFC 5545 (max 75 octets per line)."""
+    # Fast path: almost every line is short ASCII and needs no folding
+    if len(line) <= 75 and line.isascii():
+        return line
+
+    data = line.encode("utf-8")
+    if len(data) <= 75:
+        return line
+
+    # Work on the encoded bytes once; continuation lines start with a space,
+    # so they carry at most 74 octets of content.
     result = []
-    while len(line.encode("utf-8")) > 75:
-        cut = 75
-        while cut > 0 and len(line[:cut].encode("utf-8")) > 75:
+    start, limit = 0, 75
+    while len(data) - start > limit:
+        cut = start + limit
+        # Never split inside a multi-byte UTF-8 sequence; continuation
+        # bytes are 0b10xxxxxx, so this backs off at most 3 bytes
+        while cut > start and (data[cut] & 0xC0) == 0x80:
             cut -= 1
-        if cut == 0:
-            cut = 1
-        result.append(line[:cut])
-        line = " " + line[cut:]
-    result.append(line)
-    return "\r\n".join(result)
+        result.append(data[start:cut].decode("utf-8"))
+        start, limit = cut, 74
+    result.append(data[start:].decode("utf-8"))
+    return "\r\n ".join(result)
 
 
 def build_vtimezone():
@@ -182,17 +365,26 @@ def build_vtimezone():
     )
 
 
-def build_vevent(date, event_key, summary, start_dt, end_dt, alarm_min):
-    """Build a single VEVENT string."""
-    now_utc = datetime.now(pytz.utc)
-    uid = f"{date.strftime('%Y%m%d')}-{event_key}@mcws-naqshbandi"
+def build_vevent(f, dtstamp_line, date, event_key, summary,
+                 start_min, end_min, alarm_min):
+    """Write the folded, CRLF-terminated lines of a single VEVENT to f.
 
+    start_min and end_min are local minutes since midnight of date.
+    """
+    f.write(VEVENT_TPL % {
+        "date": f"{date.year:04d}{date.month:02d}{date.day:02d}",
+        "key": event_key,
+        "stamp": dtstamp_line,
+        "start": fmt_local(date, start_min),
+        "end": fmt_local(date, end_min),
+        "tail": vevent_tail(summary, alarm_min),
+    })
+
+
+@functools.lru_cache(maxsize=None)
+def vevent_tail(summary, alarm_min):
+    """Folded SUMMARY/VALARM lines of a VEVENT; identical for every day."""
     lines = [
-        "BEGIN:VEVENT",
-        f"UID:{uid}",
-        f"DTSTAMP:{fmt_utc(now_utc)}",
-        f"DTSTART;TZID={TIMEZONE}:{fmt_dt(start_dt)}",
-        f"DTEND;TZID={TIMEZONE}:{fmt_dt(end_dt)}",
         f"SUMMARY:{summary}",
         "BEGIN:VALARM",
         f"TRIGGER:-PT{alarm_min}M",
@@ -201,21 +393,18 @@ def build_vevent(date, event_key, summary, start_dt, end_dt, alarm_min):
         "END:VALARM",
         "END:VEVENT",
     ]
+    return "".join(fold_line(line) + "\r\n" for line in lines)
 
-    folded = []
-    for line in lines:
-        folded.append(fold_line(line))
-
-    return "\r\n".join(folded)
 
-
-def make_dt(date, hour, minute):
-    """Create a timezone-aware datetime from date and hour/minute tuple."""
-    return TZ.localize(datetime(date.year, date.month, date.day, hour, minute))
+def generate_ics(all_days):
+    """Generate the full ICS content as a string."""
+    buf = io.StringIO()
+    write_ics(buf, all_days)
+    return buf.getvalue()
 
 
-def generate_ics(all_days):
-    """Generate the full ICS content."""
+def write_ics(f, all_days):
+    """Stream the full ICS content to the text file object f."""
     header = (
         "BEGIN:VCALENDAR\r\n"
         "VERSION:2.0\r\n"
@@ -223,41 +412,53 @@ def generate_ics(all_days):
         "CALSCALE:GREGORIAN\r\n"
         "METHOD:PUBLISH\r\n"
         "X-WR-CALNAME:Naqshbandi Wird Schedule\r\n"
-        "X-WR-TIMEZONE:America/Detroit"
+        "X-WR-TIMEZONE:America/Detroit\r\n"
     )
 
-    parts = [header, build_vtimezone()]
+    # One DTSTAMP for the whole run
+    dtstamp_line = f"DTSTAMP:{fmt_utc(datetime.now(UTC))}"
 
-    for date in sorted(all_days.keys()):
-        times = all_days[date]
-
-        for event_key, summary, offset, duration, alarm, prayer_key in EVENTS:
-            prayer_time = times.get(prayer_key)
-            if prayer_time is None:
-                continue
-            hour, minute = prayer_time
+    f.write(header)
+    f.write(build_vtimezone())
+    f.write("\r\n")
 
-            start_dt = make_dt(date, hour, minute) - timedelta(minutes=offset)
-            end_dt = start_dt + timedelta(minutes=duration)
+    # Days are independent, but the whole calendar builds in a few ms --
+    # less than starting a process pool -- so they are written in order.
+    for date in sorted(all_days.keys()):
+        write_day_events(f, dtstamp_line, date, all_days[date])
 
-            vevent = build_vevent(date, event_key, summary, start_dt, end_dt, alarm)
-            parts.append(vevent)
+    f.write("END:VCALENDAR\r\n")
 
-            # After Fajr event, insert Worship Time (fajr end -> sunrise)
-            if event_key == "fajr":
-                sunrise = times.get("sunrise")
-                if sunrise:
-                    sunrise_dt = make_dt(date, sunrise[0], sunrise[1])
-                    # Worship starts when Fajr event ends
-                    if end_dt < sunrise_dt:
-                        worship = build_vevent(
-                            date, "worship", "Worship Time",
-                            end_dt, sunrise_dt, 0
-                        )
-                        parts.append(worship)
 
-    parts.append("END:VCALENDAR")
-    return "\r\n".join(parts)
+def write_day_events(f, dtstamp_line, date, times):
+    """Write all VEVENTs for a single day's prayer times to f."""
+    for event_key, summary, offset, duration, alarm, prayer_key in EVENTS:
+        prayer_time = times.get(prayer_key)
+        if prayer_time is None:
+            continue
+        hour, minute = prayer_time
+
+        # Times are plain local minutes since midnight; DTSTART/DTEND
+        # carry TZID so no timezone conversion is needed here.
+        start_min = hour * 60 + minute - offset
+        end_min = start_min + duration
+
+        build_vevent(
+            f, dtstamp_line, date, event_key, summary,
+            start_min, end_min, alarm
+        )
+
+        # After Fajr event, insert Worship Time (fajr end -> sunrise)
+        if event_key == "fajr":
+            sunrise = times.get("sunrise")
+            if sunrise:
+                sunrise_min = sunrise[0] * 60 + sunrise[1]
+                # Worship starts when Fajr event ends
+                if end_min < sunrise_min:
+                    build_vevent(
+                        f, dtstamp_line, date, "worship", "Worship Time",
+                        end_min, sunrise_min, 0
+                    )
 
 
 def main():
@@ -275,11 +476,13 @@ def main():
     print(f"Date range: {min(all_days.keys())} to {max(all_days.keys())}")
 
     print("\nGenerating ICS...")
-    ics_content = generate_ics(all_days)
-
+    # Write to a temporary file first so a failure mid-way leaves the
+    # published feed untouched
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    with open(OUTPUT_FILE, "w", encoding="utf-8", newline="") as f:
-        f.write(ics_content)
+    tmp_path = f"{OUTPUT_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        write_ics(f, all_days)
+    os.replace(tmp_path, OUTPUT_FILE)
 
     total_events = len(all_days) * 7  # 6 prayers + worship
     print(f"Written {OUTPUT_FILE}")